@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 from pathlib import Path
 from typing import List, Optional, Dict, Any
@@ -7,10 +8,14 @@ import typer
 import yaml
 from dotenv import load_dotenv
 
-# Import the lightweight modules at the top level
-from .importers import docs_importer, sql_importer, twitter_api_importer, twitter_importer
-from .processing import sft_unify_and_split
-# NOTE: The heavy training and inference modules are now imported locally inside their commands.
+# NOTE: Importer, processing, training and inference modules are imported locally inside
+# their commands so that `--help` and unrelated commands don't pay for their dependencies.
+
+# Prefer libyaml's C parser when PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 # --- Configuration ---
 APP_DIR = Path(__file__).resolve().parent.parent.parent
@@ -29,15 +34,27 @@ app = typer.Typer(
 
 # --- Config Loading ---
 def load_config() -> dict:
-    if CONFIG_FILE.exists():
+    try:
         with open(CONFIG_FILE, "r") as f:
-            try: return yaml.safe_load(f)
+            try: return yaml.load(f, Loader=_YamlLoader) or {}
             except yaml.YAMLError as e:
                 typer.secho(f"Warning: Could not parse config.yaml. Error: {e}", fg=typer.colors.YELLOW)
+    except FileNotFoundError:
+        pass
     return {}
 config = load_config()
 
 # --- Helper Functions ---
+_INT_RE = re.compile(r"-?\d+")
+_FLOAT_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def _coerce_cli_value(value: str) -> Any:
+    """Converts a raw `--key value` override to int, bool or float where it looks like one."""
+    if _INT_RE.fullmatch(value): return int(value)
+    if value.lower() in ('true', 'false'): return value.lower() == 'true'
+    if _FLOAT_RE.fullmatch(value): return float(value)
+    return value
+
 def _ensure_venv():
     if sys.prefix == sys.base_prefix:
         typer.secho(f"Error: Not in a virtual environment. Please run 'source {VENV_DIR.name}/bin/activate' first.", fg=typer.colors.RED)
@@ -79,13 +96,7 @@ def _build_train_config(ctx: typer.Context, preset: Optional[str]) -> Dict[str,
         if arg.startswith('--'):
             key = arg[2:].replace('-', '_')
             if i + 1 < len(args_list) and not args_list[i+1].startswith('--'):
-                value = args_list[i+1]
-                if value.isdigit(): value = int(value)
-                elif value.lower() in ['true', 'false']: value = value.lower() == 'true'
-                else:
-                    try: value = float(value)
-                    except ValueError: pass
-                cli_args[key] = value
+                cli_args[key] = _coerce_cli_value(args_list[i+1])
                 i += 2
             else:
                 cli_args[key] = True
@@ -117,6 +128,8 @@ def twitter_import_cmd(
     role_assistant: str = typer.Option("model", help="Role name for your replies ('model' or 'assistant')."),
 ):
     """Imports and converts a one-time Twitter/X archive."""
+    from .importers import twitter_importer
+
     twitter_importer.process_archive(
         archive_path=archive_path,
         out_path=out,
@@ -140,6 +153,8 @@ def twitter_api_import_cmd(
     role_assistant: str = typer.Option("model", help="Role name for your replies ('model' or 'assistant')."),
 ):
     """Incrementally syncs new tweets from the Twitter API."""
+    from .importers import twitter_api_importer
+
     exclude_sources_set = {s.strip() for s in exclude_sources.split(',') if s.strip()}
     twitter_api_importer.sync_tweets(
         username=username,
@@ -163,6 +178,8 @@ def sql_import_cmd(
     role_assistant: str = typer.Option("model", help="Role name for your replies ('model' or 'assistant').")
 ):
     """Imports and converts threads from a SQL database with a sidecar .yaml config."""
+    from .importers import sql_importer
+
     sql_importer.process_database(
         db_path=input_path,
         out_path=out,
@@ -181,8 +198,11 @@ def docs_import_cmd(
     max_chars: int = typer.Option(1200, help="Maximum character length for a text chunk."),
     tag_lang: str = typer.Option("", help="Language tag to add to each record (e.g., 'en', 'he')."),
     delete_missing: bool = typer.Option(False, help="Prune state entries for files that no longer exist."),
+    workers: int = typer.Option(0, help="Number of worker processes for parsing documents. 0 uses all CPU cores."),
 ):
     """Incrementally ingests documents (.txt, .md, .html, .docx, .pdf) into SFT JSONL."""
+    from .importers import docs_importer
+
     docs_importer.process_documents(
         root_path=path,
         out_path=out,
@@ -191,6 +211,7 @@ def docs_import_cmd(
         max_chars=max_chars,
         tag_lang=tag_lang,
         delete_missing=delete_missing,
+        workers=workers,
     )
 
 @app.command()
@@ -200,13 +221,18 @@ def unify(
     shuffle: bool = typer.Option(True, help="Shuffle the unified dataset."),
     seed: int = typer.Option(42, help="Random seed for shuffling."),
     keep: str = typer.Option("messages,created_at", help="Comma-separated list of keys to keep."),
-    drop_generic_prompts: bool = typer.Option(False, help="Filter out examples with generic prompts like '...'.")
+    drop_generic_prompts: bool = typer.Option(False, help="Filter out examples with generic prompts like '...'."),
+    workers: int = typer.Option(0, help="Number of worker processes for normalizing rows. 0 uses all CPU cores."),
 ):
     """Unifies and normalizes multiple JSONL datasets into one."""
+    from .processing import sft_unify_and_split
+
     input_paths = inputs
-    if not input_paths:
-        input_paths = [p for p in DATASET_DIR.glob("*.jsonl") if p.is_file()]
-        input_paths = [p for p in input_paths if p.resolve() != out.resolve() and "_eval" not in p.stem and "train" not in p.stem]
+    if not input_paths and DATASET_DIR.is_dir():
+        out_resolved = out.resolve()
+        with os.scandir(DATASET_DIR) as entries:
+            candidates = [Path(e.path) for e in entries if e.name.endswith(".jsonl") and e.is_file()]
+        input_paths = [p for p in candidates if "_eval" not in p.stem and "train" not in p.stem and p.resolve() != out_resolved]
 
     if not input_paths:
         typer.secho("No input files found to unify.", fg=typer.colors.YELLOW)
@@ -225,6 +251,7 @@ def unify(
         seed=seed,
         keep_keys=keep_keys,
         drop_generic_prompts=drop_generic_prompts,
+        workers=workers,
     )
 
 @app.command("split-eval")
@@ -236,6 +263,8 @@ def split_eval(
     seed: int = typer.Option(42, help="Random seed for shuffling."),
 ):
     """Splits a unified dataset into training and evaluation sets."""
+    from .processing import sft_unify_and_split
+
     sft_unify_and_split.split_dataset(
         input_path=in_file,
         train_path=train_out,
@@ -244,20 +273,30 @@ def split_eval(
         seed=seed,
     )
 
+def _configure_hf_hub(settings: Dict[str, Any]):
+    """Sets Hub environment variables; huggingface_hub reads them once at import, so call this first."""
+    import importlib.util
+    if settings.get("hf_home"):
+        os.environ["HF_HOME"] = str(Path(settings["hf_home"]).expanduser())
+    # Parallel Rust downloader for large checkpoint shards; the Hub errors if it is enabled but missing.
+    if importlib.util.find_spec("hf_transfer") is not None:
+        os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 @app.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})
 def train(
     ctx: typer.Context,
     preset: Optional[str] = typer.Option(None, help="Hardware preset to use from config.yaml."),
 ):
     """Fine-tunes the language model using a hierarchical configuration."""
-    from .training import sft_trainer
-
     settings = _build_train_config(ctx, preset)
     
     if not Path(settings['data']).exists():
         typer.secho(f"Error: Training data file not found at '{settings['data']}'.", fg=typer.colors.RED)
         typer.secho("Please create it by running the import and unify commands.", fg=typer.colors.RED)
         raise typer.Exit(1)
+
+    _configure_hf_hub(settings)
+    from .training import sft_trainer
         
     typer.echo("--- Final Training Configuration ---")
     for key, val in sorted(settings.items()):
@@ -271,7 +310,7 @@ def infer(
     prompt: str = typer.Argument(..., help="The prompt to send to the model."),
     adapter_dir: Optional[Path] = typer.Option(None, help="Path to the LoRA adapter. If not provided, uses the base model."),
     model_name: Optional[str] = typer.Option(None, help="The base model name to use."),
-    load_in_4bit: bool = typer.Option(False, help="Use 4-bit quantization."),
+    load_in_4bit: Optional[bool] = typer.Option(None, "--load-in-4bit/--no-load-in-4bit", help="Use 4-bit quantization. Defaults to on when CUDA and bitsandbytes are available."),
 ):
     """Runs interactive inference with a trained LoRA adapter."""
     from .inference import inference
@@ -1,87 +1,143 @@
 # src/lora_sftuner/importers/docs_importer.py
 
+import base64
+import binascii
 import datetime
+import functools
 import hashlib
 import html
+import importlib
 import json
+import os
 import pathlib
 import re
-from typing import Dict, Iterable, List, Optional
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional
 
 from tqdm import tqdm
 
+from ..processing import fast_json
+
 # --- Optional Dependency Handling ---
-try:
-    from bs4 import BeautifulSoup
-except ImportError:
-    BeautifulSoup = None
+# Parsers are imported on first use so that importing this module stays cheap.
+
+_OPTIONAL_MODULES: Dict[str, Optional[object]] = {}
+
+def _optional_import(name: str):
+    """Imports an optional module once, returning None if it is not installed."""
+    if name not in _OPTIONAL_MODULES:
+        try:
+            _OPTIONAL_MODULES[name] = importlib.import_module(name)
+        except ImportError:
+            _OPTIONAL_MODULES[name] = None
+    return _OPTIONAL_MODULES[name]
 
-try:
-    import docx  # python-docx
-except ImportError:
-    docx = None
+def _lexbor():
+    return _optional_import("selectolax.lexbor")  # selectolax (much faster than bs4)
 
-try:
-    import fitz  # PyMuPDF
-except ImportError:
-    fitz = None
+def _bs4():
+    return _optional_import("bs4")
+
+def _docx():
+    return _optional_import("docx")  # python-docx
+
+def _fitz():
+    return _optional_import("fitz")  # PyMuPDF
 
 SUPPORTED_EXT = {".txt", ".md", ".markdown", ".html", ".htm", ".docx", ".pdf"}
+STATE_CHECKPOINT_EVERY = 200  # Save state after this many processed files so crashes can resume.
+PARALLEL_MIN_FILES = 8  # Below this many changed files, process pool startup costs more than it saves
 
 # --- Text Processing and Chunking ---
 
+_RE_HSPACE = re.compile(r"[ \t\f\v]+")
+_RE_MULTINL = re.compile(r"\n{3,}")
+_RE_HASH_WS = re.compile(r"\s+")
+_RE_URL = re.compile(r"https?://\S+")
+_RE_WORD = re.compile(r"[A-Za-z\u0590-\u05FF][\w’׳״'-]{2,}")
+_RE_PARA = re.compile(r"\n\s*\n")
+
 def _norm_ws(s: str) -> str:
     s = s.replace("\r\n", "\n").replace("\r", "\n")
-    s = re.sub(r"[ \t\f\v]+", " ", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
+    s = _RE_HSPACE.sub(" ", s)
+    s = _RE_MULTINL.sub("\n\n", s)
     return s.strip()
 
 def _norm_text_for_hash(t: str) -> str:
-    return re.sub(r"\s+", " ", html.unescape(t or "")).strip().lower()
+    return _RE_HASH_WS.sub(" ", html.unescape(t or "")).strip().lower()
 
-def _sha256_text(t: str) -> str:
-    return hashlib.sha256(_norm_text_for_hash(t).encode("utf-8")).hexdigest()
+CHUNK_DIGEST_SIZE = 16
 
-def _topic_keywords(t: str, limit=8) -> List[str]:
-    t = re.sub(r"https?://\S+", "", t)
-    words = re.findall(r"[A-Za-z\u0590-\u05FF][\w’׳״'-]{2,}", t)
-    out = {w.lower() for w in words}
-    return list(out)[:limit] or ["general"]
+def _hash_text(t: str) -> bytes:
+    # BLAKE2b-128 is stdlib, faster than SHA-256 in CPython, and stable across environments,
+    # which matters because these digests are persisted in the state file.
+    return hashlib.blake2b(_norm_text_for_hash(t).encode("utf-8"), digest_size=CHUNK_DIGEST_SIZE).digest()
 
-def _split_paragraphs(text: str) -> List[str]:
-    parts = [p.strip() for p in re.split(r"\n\s*\n", text)]
-    return [p for p in parts if p]
+def _hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _topic_keywords(t: str, limit=8) -> List[str]:
+    """Returns the first `limit` distinct words, in order of appearance, so prompts are reproducible."""
+    t = _RE_URL.sub("", t)
+    seen, out = set(), []
+    for m in _RE_WORD.finditer(t):
+        w = m.group().lower()
+        if w not in seen:
+            seen.add(w)
+            out.append(w)
+            if len(out) >= limit:
+                break
+    return out or ["general"]
+
+def _iter_paragraphs(text: str) -> Iterator[str]:
+    """Lazily yields the non-empty, stripped paragraphs of `text` (blank-line separated)."""
+    start = 0
+    for m in _RE_PARA.finditer(text):
+        par = text[start:m.start()].strip()
+        if par: yield par
+        start = m.end()
+    par = text[start:].strip()
+    if par: yield par
 
 # --- Document Readers ---
 
 def _read_txt(path: pathlib.Path) -> str:
+    data = path.read_bytes() # Read once; decode again only if the UTF-8 attempt fails
     try:
-        return path.read_text(encoding="utf-8")
+        return data.decode("utf-8")
     except UnicodeDecodeError:
-        return path.read_text(encoding="cp1255", errors="ignore")
+        return data.decode("cp1255", errors="ignore")
 
 def _read_html(path: pathlib.Path) -> str:
-    if not BeautifulSoup:
-        raise ImportError("HTML processing requires 'beautifulsoup4'. Please install with `pip install -e \".[docs]\"`")
-    soup = BeautifulSoup(path.read_text(encoding="utf-8", errors="ignore"), "html.parser")
+    lexbor = _lexbor()
+    if lexbor:
+        tree = lexbor.LexborHTMLParser(path.read_text(encoding="utf-8", errors="ignore"))
+        tree.strip_tags(["script", "style", "noscript"])
+        return tree.text(separator="\n")
+
+    bs4 = _bs4()
+    if not bs4:
+        raise ImportError("HTML processing requires 'selectolax' or 'beautifulsoup4'. Please install with `pip install -e \".[docs]\"`")
+    soup = bs4.BeautifulSoup(path.read_text(encoding="utf-8", errors="ignore"), "html.parser")
     for tag in soup(["script", "style", "noscript"]):
         tag.decompose()
     return soup.get_text("\n")
 
 def _read_docx(path: pathlib.Path) -> str:
+    docx = _docx()
     if not docx:
         raise ImportError("DOCX processing requires 'python-docx'. Please install with `pip install -e \".[docs]\"`")
     doc = docx.Document(path)
     return "\n".join(p.text for p in doc.paragraphs)
 
 def _read_pdf(path: pathlib.Path) -> str:
+    fitz = _fitz()
     if not fitz:
         raise ImportError("PDF processing requires 'PyMuPDF'. Please install with `pip install -e \".[docs]\"`")
-    text = ""
     with fitz.open(path) as doc:
-        for page in doc:
-            text += page.get_text() + "\n"
-    return text
+        return "\n".join(page.get_text("text", sort=False) for page in doc)
 
 def _load_text_from_file(path: pathlib.Path) -> str:
     """Dispatcher to call the correct reader based on file extension."""
@@ -109,18 +165,106 @@ def _make_style_example(txt: str, src_path: str, lang: str) -> Dict:
 def _load_state(path: pathlib.Path) -> Dict:
     if path.exists():
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
+            return fast_json.loads(path.read_bytes())
         except (json.JSONDecodeError, TypeError):
             pass
     return {"files": {}}
 
+def _pack_chunks(hashes: List[bytes]) -> str:
+    """Packs raw chunk digests into one base64 string (about half the size of a hex list)."""
+    return base64.b64encode(b"".join(hashes)).decode("ascii")
+
+def _unpack_chunks(info: Dict) -> FrozenSet[bytes]:
+    """Returns the known chunk digests of a state entry, accepting the legacy hex-list format."""
+    packed = info.get("chunks_b64")
+    if packed is not None:
+        try:
+            data = base64.b64decode(packed)
+        except (binascii.Error, ValueError):
+            return frozenset()
+        return frozenset(data[i:i + CHUNK_DIGEST_SIZE] for i in range(0, len(data), CHUNK_DIGEST_SIZE))
+    known = set()
+    for h in info.get("chunks", []):
+        try:
+            known.add(bytes.fromhex(h))
+        except (TypeError, ValueError):
+            continue
+    return frozenset(known)
+
 def _save_state(path: pathlib.Path, state: Dict):
     path.parent.mkdir(parents=True, exist_ok=True)
-    state["last_run_at"] = datetime.datetime.utcnow().isoformat() + "Z"
-    path.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    state["last_run_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+    fast_json.dump_file_atomic(path, state)
+
+# --- File Discovery ---
+
+def _iter_supported_files(root: str) -> Iterator[os.DirEntry]:
+    """Recursively yields entries for supported files. DirEntry caches its stat result."""
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_supported_files(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXT:
+                yield entry
+
+# --- Per-File Worker ---
+
+@dataclass
+class _FileResult:
+    """What a worker learned about one file; the parent process owns output and state."""
+    status: str  # "ok", "unchanged", "empty" or "error"
+    content_hash: Optional[str] = None
+    error: Optional[str] = None
+    lines: List[bytes] = field(default_factory=list)  # JSONL records for new chunks
+    chunk_hashes: List[bytes] = field(default_factory=list)  # all chunks currently in the file
+
+def _process_one(
+    fp: pathlib.Path,
+    prev_content_hash: Optional[str],
+    known: FrozenSet[bytes],
+    min_chars: int,
+    max_chars: int,
+    tag_lang: str,
+) -> _FileResult:
+    """Reads, chunks and hashes a single document. Runs in a worker process."""
+    try:
+        content_hash = _hash_bytes(fp.read_bytes())
+    except OSError as e:
+        return _FileResult("error", error=str(e))
+    if content_hash == prev_content_hash:
+        return _FileResult("unchanged", content_hash=content_hash)
+
+    try:
+        text = _load_text_from_file(fp)
+    except Exception as e:
+        return _FileResult("error", error=str(e))
+    if not text:
+        return _FileResult("empty", content_hash=content_hash)
+
+    result = _FileResult("ok", content_hash=content_hash)
+    src_path = str(fp)
+    # Simple chunking, can be improved later: rejected paragraphs never reach the hash loop
+    kept = (par for par in _iter_paragraphs(_norm_ws(text)) if min_chars <= len(par) <= max_chars)
+    hashed = [(_hash_text(par), par) for par in kept]
+    new_hashes = {h for h, _ in hashed}
+    result.lines = [
+        fast_json.dumps_line(_make_style_example(par, src_path, tag_lang))
+        for h, par in hashed if h not in known
+    ]
+
+    result.chunk_hashes = sorted(new_hashes)
+    return result
 
 # --- Main Processing Function ---
 
+def _run_jobs(worker, paths, prev_hashes, knowns, workers: int):
+    """Yields per-file results in input order, in worker processes only when there are enough files."""
+    if len(paths) < PARALLEL_MIN_FILES or workers == 1:
+        yield from map(worker, paths, prev_hashes, knowns)
+        return
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        yield from executor.map(worker, paths, prev_hashes, knowns, chunksize=4)
+
 def process_documents(
     root_path: pathlib.Path,
     out_path: pathlib.Path,
@@ -129,54 +273,68 @@ def process_documents(
     max_chars: int,
     tag_lang: str,
     delete_missing: bool,
+    workers: int = 0,
 ):
     """Incrementally ingests documents from a directory into SFT JSONL format."""
     state = _load_state(state_path)
     
-    files_to_process = [
-        p for p in root_path.rglob("*") if p.is_file() and p.suffix.lower() in SUPPORTED_EXT
-    ]
+    if root_path.is_file():
+        files_to_process = [(root_path, root_path.stat())] if root_path.suffix.lower() in SUPPORTED_EXT else []
+    else:
+        files_to_process = [(pathlib.Path(e.path), e.stat()) for e in _iter_supported_files(str(root_path))]
     
     added_count = 0
+    processed_count = 0
     seen_files = set()
 
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # Cheap stat-based skip happens here; everything else is farmed out to workers
+    jobs = []
+    for fp, stat in files_to_process:
+        file_key = str(fp.resolve())
+        seen_files.add(file_key)
+
+        info = state["files"].get(file_key, {})
+        if info.get("mtime") == stat.st_mtime and info.get("size") == stat.st_size:
+            continue # Skip unchanged files
+        jobs.append((fp, file_key, stat, info))
 
-    with out_path.open("a", encoding="utf-8") as out_f:
-        for fp in tqdm(files_to_process, desc="Processing documents"):
-            file_key = str(fp.resolve())
-            seen_files.add(file_key)
-            stat = fp.stat()
-            
-            info = state["files"].get(file_key, {})
-            if info.get("mtime") == stat.st_mtime and info.get("size") == stat.st_size:
-                continue # Skip unchanged files
-
-            try:
-                text = _load_text_from_file(fp)
-                if not text: continue
-            except Exception as e:
-                print(f"\n[Warning] Failed to read {fp.name}: {e}")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    worker = functools.partial(_process_one, min_chars=min_chars, max_chars=max_chars, tag_lang=tag_lang)
+    paths = [fp for fp, _, _, _ in jobs]
+    prev_hashes = [info.get("content_hash") for _, _, _, info in jobs]
+    knowns = [_unpack_chunks(info) for _, _, _, info in jobs]
+
+    with out_path.open("ab", buffering=1 << 20) as out_f:
+        results = _run_jobs(worker, paths, prev_hashes, knowns, workers)
+        # strict=True drains `results` to the end, so the pool shuts down inside this block
+        progress = tqdm(
+            zip(jobs, results, strict=True), total=len(jobs), desc="Processing documents", unit="file",
+            mininterval=0.5, smoothing=0, disable=not sys.stderr.isatty(),
+        )
+        for (fp, file_key, stat, info), res in progress:
+            if res.status == "error":
+                print(f"\n[Warning] Failed to read {fp.name}: {res.error}")
+                continue
+            if res.status == "empty":
                 continue
+            if res.status == "unchanged":
+                # Touched but identical (e.g. rsync/touch): refresh stat info and skip parsing
+                info["mtime"], info["size"] = stat.st_mtime, stat.st_size
+                continue
+
+            out_f.writelines(res.lines)
+            added_count += len(res.lines)
+            state["files"][file_key] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "content_hash": res.content_hash,
+                "chunks_b64": _pack_chunks(res.chunk_hashes),
+            }
 
-            new_hashes = set()
-            paragraphs = _split_paragraphs(_norm_ws(text))
-            
-            for par in paragraphs:
-                if len(par) < min_chars or len(par) > max_chars:
-                    continue # Simple chunking, can be improved later
-                
-                h = _sha256_text(par)
-                if h in info.get("chunks", []):
-                    new_hashes.add(h)
-                    continue
-
-                example = _make_style_example(par, str(fp), tag_lang)
-                out_f.write(json.dumps(example, ensure_ascii=False) + "\n")
-                added_count += 1
-                new_hashes.add(h)
-
-            state["files"][file_key] = {"mtime": stat.st_mtime, "size": stat.st_size, "chunks": sorted(list(new_hashes))}
+            processed_count += 1
+            if processed_count % STATE_CHECKPOINT_EVERY == 0:
+                out_f.flush() # Records must hit disk before the state claims them
+                _save_state(state_path, state)
 
     if delete_missing:
         keys_to_prune = set(state["files"].keys()) - seen_files
@@ -186,5 +344,3 @@ def process_documents(
 
     _save_state(state_path, state)
     print(f"✅ Appended {added_count} new document chunks to {out_path}")
-
-
@@ -12,55 +12,66 @@ import requests
 from tqdm import tqdm
 
 # Correctly import the shared processing functions
-from ..processing import twitter_data
+from ..processing import fast_json, twitter_data
 
 API_URL = "https://api.twitter.com/2"
+_TWEET_ID_RE = re.compile(rb'"tweet_id"\s*:\s*"?(\d+)"?')
 
 # --- Helper Functions ---
 
 def _load_state(path: Path) -> Dict[str, Any]:
     if path.exists():
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
+            return fast_json.loads(path.read_bytes())
         except (json.JSONDecodeError, TypeError):
             pass
     return {}
 
 def _save_state(path: Path, state: Dict[str, Any]):
     path.parent.mkdir(parents=True, exist_ok=True)
-    state["last_run_at"] = datetime.datetime.utcnow().isoformat() + "Z"
-    path.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    state["last_run_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+    fast_json.dump_file_atomic(path, state) # Atomic, so an interrupted save can't lose the sync position
 
 def _scan_existing_ids(out_path: Path) -> Set[str]:
     """Scans an existing JSONL file and returns a set of all tweet_ids."""
     if not out_path.exists():
         return set()
     ids = set()
-    with out_path.open("r", encoding="utf-8") as f:
+    with out_path.open("rb") as f:
         for line in f:
+            # Records we write always carry a numeric tweet_id, so a regex avoids a full parse
+            m = _TWEET_ID_RE.search(line)
+            if m:
+                ids.add(m.group(1).decode("ascii"))
+                continue
             try:
-                ids.add(str(json.loads(line).get("tweet_id")))
+                ids.add(str(fast_json.loads(line).get("tweet_id")))
             except (json.JSONDecodeError, AttributeError):
                 continue
     return ids
 
-def _get_user_id(username: str, bearer_token: str) -> str:
+def _make_session(bearer_token: str) -> requests.Session:
+    """Creates an authenticated session so all API calls reuse one keep-alive connection."""
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {bearer_token}"})
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return session
+
+def _get_user_id(session: requests.Session, username: str) -> str:
     """Fetches the Twitter user ID for a given username."""
     url = f"{API_URL}/users/by/username/{username}"
-    headers = {"Authorization": f"Bearer {bearer_token}"}
-    response = requests.get(url, headers=headers)
+    response = session.get(url, timeout=30)
     response.raise_for_status()
     return response.json()["data"]["id"]
 
-def _fetch_tweets_since(user_id: str, start_time: str, bearer_token: str, include_replies: bool):
-    """Generator that yields tweet dicts from the Twitter API v2."""
+def _fetch_tweet_pages(session: requests.Session, user_id: str, start_time: str, include_replies: bool):
+    """Generator that yields pages (lists of tweet dicts) from the Twitter API v2."""
     params = {
         "max_results": 100,
         "start_time": start_time,
         "tweet.fields": "id,text,created_at,source,referenced_tweets,lang",
         "exclude": "retweets" if include_replies else "retweets,replies",
     }
-    headers = {"Authorization": f"Bearer {bearer_token}"}
     next_token = None
     
     with tqdm(desc="Fetching tweets", unit=" tweets") as pbar:
@@ -69,7 +80,7 @@ def _fetch_tweets_since(user_id: str, start_time: str, bearer_token: str, includ
                 params["pagination_token"] = next_token
             
             try:
-                response = requests.get(f"{API_URL}/users/{user_id}/tweets", headers=headers, params=params, timeout=30)
+                response = session.get(f"{API_URL}/users/{user_id}/tweets", params=params, timeout=30)
                 if response.status_code == 429: # Rate limit
                     reset = int(response.headers.get("x-rate-limit-reset", "0"))
                     wait = max(5, reset - int(time.time()))
@@ -80,8 +91,7 @@ def _fetch_tweets_since(user_id: str, start_time: str, bearer_token: str, includ
                 
                 data = response.json()
                 tweets = data.get("data", [])
-                for t in tweets:
-                    yield t
+                yield tweets
                 pbar.update(len(tweets))
                 
                 next_token = data.get("meta", {}).get("next_token")
@@ -114,54 +124,62 @@ def sync_tweets(
     existing_ids = _scan_existing_ids(out_path)
     
     print(f"Syncing tweets for @{username} since {start_time}")
-    user_id = _get_user_id(username, bearer_token)
+    session = _make_session(bearer_token)
+    user_id = _get_user_id(session, username)
 
-    new_examples = []
-    newest_time = start_time
+    n_appended = 0
+    newest_dt = twitter_data.parse_ts(start_time) or datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    out_f = None
     
-    # Fetch all new tweets first
-    all_new_tweets = list(_fetch_tweets_since(user_id, start_time, bearer_token, include_replies))
-    
-    # Now process them
-    for tweet in tqdm(all_new_tweets, desc="Processing new tweets"):
-        tweet_id = str(tweet.get("id", ""))
-        if tweet_id in existing_ids:
-            continue
-        
-        if no_quotes and any(ref.get("type") == "quoted" for ref in tweet.get("referenced_tweets", [])):
-            continue
-
-        if tweet.get("source") in exclude_sources:
-            continue
-
-        # Use the shared unifier and example builder
-        unified_tweet = twitter_data.unify_tweet(tweet)
-        if len(unified_tweet["text"]) < min_len:
-            continue
-
-        example = twitter_data.make_style_example(unified_tweet, "Write a tweet in my style.", role_assistant)
-        if example:
-            new_examples.append(example)
-            existing_ids.add(tweet_id)
-        
-        created_at = tweet.get("created_at")
-        if created_at and created_at > newest_time:
-            newest_time = created_at
-
-    if not new_examples:
+    # Process each page as it arrives and append it right away, so progress survives a failed request
+    try:
+        for page in _fetch_tweet_pages(session, user_id, start_time, include_replies):
+            lines = []
+            for tweet in page:
+                tweet_id = str(tweet.get("id", ""))
+                if tweet_id in existing_ids:
+                    continue
+                
+                if no_quotes and any(ref.get("type") == "quoted" for ref in tweet.get("referenced_tweets", [])):
+                    continue
+
+                if tweet.get("source") in exclude_sources:
+                    continue
+
+                # Use the shared unifier and example builder
+                unified_tweet = twitter_data.unify_tweet(tweet)
+                if len(unified_tweet["text"]) < min_len:
+                    continue
+
+                example = twitter_data.make_style_example(unified_tweet, "Write a tweet in my style.", role_assistant)
+                if example:
+                    lines.append(fast_json.dumps_line(example))
+                    existing_ids.add(tweet_id)
+
+                # unify_tweet already parsed created_at into an aware datetime
+                ts = unified_tweet["ts"]
+                if ts and ts > newest_dt:
+                    newest_dt = ts
+
+            if lines:
+                if out_f is None:
+                    out_path.parent.mkdir(parents=True, exist_ok=True)
+                    out_f = out_path.open("ab")
+                out_f.writelines(lines)
+                out_f.flush()
+                n_appended += len(lines)
+    finally:
+        session.close()
+        if out_f is not None:
+            out_f.close()
+
+    if not n_appended:
         print("No new tweets found to append.")
         return
 
-    print(f"Appending {len(new_examples)} new examples to {out_path.name}")
-    with out_path.open("a", encoding="utf-8") as f:
-        for ex in new_examples:
-            f.write(json.dumps(ex, ensure_ascii=False) + "\n")
+    print(f"Appended {n_appended} new examples to {out_path.name}")
 
-    try:
-        dt = datetime.datetime.fromisoformat(newest_time.replace("Z", "+00:00"))
-        next_start_time = (dt + datetime.timedelta(seconds=1)).isoformat().replace("+00:00", "Z")
-    except ValueError:
-        next_start_time = newest_time
+    next_start_time = (newest_dt + datetime.timedelta(seconds=1)).isoformat().replace("+00:00", "Z")
 
     state["start_time"] = next_start_time
     _save_state(state_path, state)
@@ -1,14 +1,44 @@
 # src/lora_sftuner/importers/twitter_importer.py
 
 import hashlib
-import json
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Set
 
 from tqdm import tqdm
 
 # Correctly import the shared processing functions from the module in the Canvas
-from ..processing import twitter_data
+from ..processing import fast_json, twitter_data
+
+WRITE_BATCH = 1024  # JSONL records buffered per writelines() call
+PARALLEL_MIN_TWEETS = 20000  # Below this, process pool startup costs more than it saves
+HASH_CHUNKSIZE = 2048
+
+def _dedup_key(text: str) -> int:
+    """64-bit dedup key for a tweet. Unlike hash(), stable across processes and runs."""
+    digest = hashlib.blake2b(twitter_data.norm_for_dedup(text).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+def _dedup_keys(texts: List[str]):
+    """Yields dedup keys in input order, hashing in worker processes for large archives."""
+    if len(texts) < PARALLEL_MIN_TWEETS:
+        yield from map(_dedup_key, texts)
+        return
+    with ProcessPoolExecutor() as ex:
+        yield from ex.map(_dedup_key, texts, chunksize=HASH_CHUNKSIZE)
+
+def _write_jsonl(path: Path, rows: Iterable[Dict[str, Any]]):
+    """Writes rows as JSONL through a large binary buffer, in batches of encoded lines."""
+    batch: List[bytes] = []
+    with path.open("wb", buffering=1 << 20) as f:
+        for r in rows:
+            batch.append(fast_json.dumps_line(r))
+            if len(batch) >= WRITE_BATCH:
+                f.writelines(batch)
+                batch.clear()
+        f.writelines(batch)
 
 def process_archive(
     archive_path: Path,
@@ -26,13 +56,18 @@ def process_archive(
     unified = [twitter_data.unify_tweet(t) for t in tqdm(raw_tweets, desc="Normalizing tweets")]
     by_id = {t["id_str"]: t for t in unified if t["id_str"]}
     
-    kept, seen_hashes = [], set()
-    for tw in tqdm(unified, desc="Filtering & Deduplicating"):
-        if tw["is_retweet"]: continue
-        if no_quotes and tw["is_quote"]: continue
-        if not include_replies and tw["in_reply_to_id"]: continue
-        
-        h = hashlib.sha256(twitter_data.norm_for_dedup(tw["text"]).encode()).hexdigest()
+    candidates = [
+        tw for tw in unified
+        if not tw["is_retweet"]
+        and not (no_quotes and tw["is_quote"])
+        and (include_replies or not tw["in_reply_to_id"])
+    ]
+
+    # Only the texts go to the workers; the seen set stays here so the first occurrence wins.
+    kept: List[Dict[str, Any]] = []
+    seen_hashes: Set[int] = set()
+    keys = _dedup_keys([tw["text"] for tw in candidates])
+    for tw, h in tqdm(zip(candidates, keys), total=len(candidates), desc="Filtering & Deduplicating"):
         if h in seen_hashes: continue
         seen_hashes.add(h)
         kept.append(tw)
@@ -55,18 +90,15 @@ def process_archive(
         return
 
     n_eval = int(round(len(rows) * eval_pct))
-    train_rows, eval_rows = (rows[:-n_eval], rows[-n_eval:]) if n_eval > 0 else (rows, [])
+    split = len(rows) - n_eval if n_eval > 0 else len(rows)
     
+    # islice walks `rows` in place, so the split never copies the list
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as f:
-        for r in train_rows:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-    print(f"✅ Wrote {len(train_rows)} training examples to {out_path}")
+    _write_jsonl(out_path, islice(rows, split))
+    print(f"✅ Wrote {split} training examples to {out_path}")
 
-    if eval_rows:
+    if split < len(rows):
         eval_path = out_path.with_name(f"{out_path.stem}_eval.jsonl")
-        with eval_path.open("w", encoding="utf-8") as f:
-            for r in eval_rows:
-                f.write(json.dumps(r, ensure_ascii=False) + "\n")
-        print(f"✅ Wrote {len(eval_rows)} evaluation examples to {eval_path}")
+        _write_jsonl(eval_path, islice(rows, split, None))
+        print(f"✅ Wrote {len(rows) - split} evaluation examples to {eval_path}")
 
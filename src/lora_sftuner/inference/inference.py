@@ -1,5 +1,6 @@
-# src/lora_sftuner/inference.py
+# src/lora_sftuner/inference/inference.py
 
+import importlib.util
 import os
 import sys
 import threading
@@ -7,7 +8,6 @@ import subprocess
 from pathlib import Path
 from typing import Dict, Any, Optional
 
-import time  # retained (used earlier for consistency if needed)
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, BitsAndBytesConfig
 from peft import PeftModel
@@ -57,13 +57,40 @@ def _load_model_and_tokenizer(model_name: str, load_in_4bit: bool, attn_impl: st
 # Streaming Inference
 # ==============================
 
+def _encode_prompt(tokenizer, prompt: str) -> Dict[str, torch.Tensor]:
+    """Renders the chat template for a single user prompt and tokenizes it."""
+    messages = [{"role": "user", "content": prompt}]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text, return_tensors="pt")
+
+def _default_load_in_4bit() -> bool:
+    """NF4 weights by default on CUDA: decoding is memory-bound, so moving fewer bytes per token wins."""
+    return torch.cuda.is_available() and importlib.util.find_spec("bitsandbytes") is not None
+
+def _maybe_compile(model):
+    """
+    Compiles the underlying model's forward pass when Dynamo has been explicitly re-enabled
+    (e.g. TORCHDYNAMO_DISABLE=0). Compile failures fall back to eager via suppress_errors.
+    """
+    if os.environ.get("TORCHDYNAMO_DISABLE") == "1" or not torch.cuda.is_available():
+        return
+    target = model.get_base_model() if hasattr(model, "get_base_model") else model
+    try:
+        target.forward = torch.compile(target.forward, mode="reduce-overhead", fullgraph=False)
+    except Exception as e:
+        print(f"torch.compile unavailable, running eagerly: {e}")
+
 def run_inference(config: Dict[str, Any]):
     """Runs streaming inference with a base model and an optional LoRA adapter."""
     token = os.getenv("HUGGINGFACE_HUB_TOKEN")
 
-    # --- Default to 'eager' attention for better stability ---
+    load_in_4bit = config.get("load_in_4bit")
+    if load_in_4bit is None:
+        load_in_4bit = _default_load_in_4bit()
+
+    # --- SDPA uses fused attention kernels where available ---
     base_model, tokenizer = _load_model_and_tokenizer(
-        config["model_name"], config.get("load_in_4bit", False), config.get("attn", "eager"), token
+        config["model_name"], load_in_4bit, config.get("attn", "sdpa"), token
     )
 
     if config.get("adapter_dir"):
@@ -73,10 +100,9 @@ def run_inference(config: Dict[str, Any]):
         model = base_model
 
     model.eval()
+    _maybe_compile(model)
 
-    messages = [{"role": "user", "content": config["prompt"]}]
-    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    inputs = _encode_prompt(tokenizer, config["prompt"]).to(model.device)
 
     streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
 
@@ -141,6 +167,17 @@ def _resolve_repo_from_binary(bin_name: str) -> Optional[Path]:
         pass
     return None
 
+def _paths_for_repo(repo: Path) -> Dict[str, Path]:
+    """Standard layout of a llama.cpp checkout built with CMake."""
+    venv_py = repo / ".venv" / "bin" / "python"
+    return {
+        "llama_dir": repo,
+        "venv_python": venv_py if venv_py.is_file() else Path(sys.executable),
+        "converter": repo / "convert_hf_to_gguf.py",
+        "quantize": repo / "build" / "bin" / "llama-quantize",
+        "cli": repo / "build" / "bin" / "llama-cli",
+    }
+
 def _llama_paths() -> Dict[str, Path]:
     """
     Locate llama.cpp repo, its venv python, converter script, and binaries.
@@ -155,27 +192,13 @@ def _llama_paths() -> Dict[str, Path]:
     if env_home:
         repo = Path(env_home).expanduser().resolve()
         if (repo / "convert_hf_to_gguf.py").is_file():
-            venv_py = repo / ".venv" / "bin" / "python"
-            return {
-                "llama_dir": repo,
-                "venv_python": venv_py if venv_py.is_file() else Path(sys.executable),
-                "converter": repo / "convert_hf_to_gguf.py",
-                "quantize": repo / "build" / "bin" / "llama-quantize",
-                "cli": repo / "build" / "bin" / "llama-cli",
-            }
+            return _paths_for_repo(repo)
 
     # 2) Derive from PATHed binaries
     for name in ("llama-quantize", "llama-cli"):
         repo = _resolve_repo_from_binary(name)
         if repo:
-            venv_py = repo / ".venv" / "bin" / "python"
-            return {
-                "llama_dir": repo,
-                "venv_python": venv_py if venv_py.is_file() else Path(sys.executable),
-                "converter": repo / "convert_hf_to_gguf.py",
-                "quantize": repo / "build" / "bin" / "llama-quantize",
-                "cli": repo / "build" / "bin" / "llama-cli",
-            }
+            return _paths_for_repo(repo)
 
     # 3) Last-resort: return placeholders so _check_llama_tools can error clearly
     return {
@@ -0,0 +1,39 @@
+# src/lora_sftuner/processing/fast_json.py
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Union
+
+# --- Optional Dependency Handling ---
+# orjson is a C serializer that is several times faster than the stdlib json module.
+# Its JSONDecodeError subclasses json.JSONDecodeError, so callers can keep catching the latter.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(obj: Any) -> bytes:
+    """Serializes to compact UTF-8 JSON bytes, keeping non-ASCII characters as-is."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def dumps_line(obj: Any) -> bytes:
+    """Serializes a single JSONL record, including the trailing newline."""
+    return dumps(obj) + b"\n"
+
+def dumps_pretty(obj: Any) -> bytes:
+    """Serializes with 2-space indentation, for human-readable state files."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+def loads(data: Union[bytes, str]) -> Any:
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def dump_file_atomic(path: Path, obj: Any):
+    """Writes pretty JSON to a temp file and renames it over `path`, so readers never see a partial file."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(dumps_pretty(obj))
+    os.replace(tmp, path)
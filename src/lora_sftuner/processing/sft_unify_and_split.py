@@ -1,39 +1,77 @@
 # src/lora_sftuner/processing/sft_unify_and_split.py
 
+import functools
 import hashlib
 import html
 import json
+import mmap
+import os
 import pathlib
 import random
 import re
 from collections import Counter
-from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 from tqdm import tqdm
 
+from . import fast_json
+
+# --- Optional Dependency Handling ---
+# xxh3 is a non-cryptographic hash many times faster than SHA-256; dedup only needs collision resistance.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # --- Text Normalization and Hashing ---
 
+_TAG_RE = re.compile(r"<[^>]+>")
+# Same character-reference grammar html.unescape uses; the few entities that dominate real text
+# resolve with a dict lookup, anything else goes through html.unescape.
+_ENTITY_RE = re.compile(r"&(#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;]{1,32};?)")
+_COMMON_ENTITIES = {"&amp;": "&", "&lt;": "<", "&gt;": ">", "&quot;": '"', "&#39;": "'", "&nbsp;": "\xa0"}
+
+def _replace_entity(m: re.Match) -> str:
+    ref = m.group(0)
+    return _COMMON_ENTITIES.get(ref) or html.unescape(ref)
+
 def _norm_text(t: str) -> str:
     """Cleans text by removing HTML tags, unescaping entities, and normalizing whitespace."""
     if not t:
         return ""
-    # Remove HTML tags
-    t = re.sub(r"<[^>]+>", " ", t)
-    # Unescape HTML entities
-    t = html.unescape(t)
-    # Normalize whitespace
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
-
-def _hash_for_dedup(messages: List[Dict[str, str]]) -> str:
-    """Creates a hash from the last assistant message for deduplication."""
+    # Remove HTML tags and unescape entities, skipping either pass when it can't match (typical for tweets)
+    if "<" in t:
+        # Tags can only end at or before the last ">". Leaving the tail out keeps the scan linear:
+        # every unclosed "<" in it would otherwise rescan to the end of the string.
+        end = t.rfind(">") + 1
+        if end:
+            t = _TAG_RE.sub(" ", t[:end]) + t[end:]
+    if "&" in t:
+        t = _ENTITY_RE.sub(_replace_entity, t)
+    # Normalize whitespace. str.split() breaks on exactly the characters \s matches, in a single C
+    # loop, so this equals re.sub(r"\s+", " ", t).strip() without going through the regex engine.
+    return " ".join(t.split())
+
+def _digest128(data: bytes) -> int:
+    """128-bit digest as an int, which is smaller and faster to look up in a set than a hex string."""
+    if xxhash:
+        return xxhash.xxh3_128_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=16).digest(), "little")
+
+def _hash_for_dedup(messages: List[Dict[str, str]]) -> int:
+    """
+    Creates a hash from the last assistant message for deduplication.
+    Expects messages from _normalize_row: content has already been through _norm_text, and
+    the only newlines left are the "\n\n" separators of merged turns, which fold to a space.
+    """
     for m in reversed(messages):
-        if m.get("role", "").lower() in ("assistant", "model"):
-            return hashlib.sha256(_norm_text(m.get("content", "")).lower().encode()).hexdigest()
+        if m["role"] == "assistant":
+            return _digest128(m["content"].replace("\n\n", " ").lower().encode())
     # Fallback: hash the whole dialog
-    stitched = " ".join(_norm_text(m.get("content", "")) for m in messages)
-    return hashlib.sha256(stitched.lower().encode()).hexdigest()
+    stitched = " ".join(m["content"].replace("\n\n", " ") for m in messages)
+    return _digest128(stitched.lower().encode())
 
 # --- Role and Message Normalization ---
 
@@ -47,41 +85,42 @@ def _enforce_alternation(cleaned: List[Dict[str, str]]) -> Optional[List[Dict[st
     """
     Enforces a [system?, user, assistant, user, ...] structure.
     This version is more careful about preserving multi-turn conversations.
+    Built in a single pass: once consecutive same-role messages are merged, neighbours always
+    differ, so a user/assistant body alternates by construction and only its ends and any
+    stray system messages need checking.
     """
     if not cleaned: return None
 
-    # 1. Merge true consecutive messages of the same role
-    merged = []
+    out = []
+    # Insert a synthetic prompt to fix conversations starting with the assistant
+    if cleaned[0]["role"] == "assistant":
+        out.append({"role": "user", "content": "..."})
+
+    n_misplaced_system = 0 # System messages anywhere but first
     for msg in cleaned:
-        if merged and merged[-1]["role"] == msg["role"]:
-            merged[-1]["content"] = (merged[-1]["content"] + "\n\n" + msg["content"]).strip()
-        else:
-            merged.append(msg)
-    
-    # 2. Ensure the conversation starts with a non-assistant message
-    if not merged or merged[0]["role"] == "assistant":
-        # Insert a synthetic prompt to fix conversations starting with the assistant
-        merged.insert(0, {"role": "user", "content": "..."})
-
-    # 3. Ensure the conversation ends with an assistant message
-    if merged[-1]["role"] != "assistant":
-        merged.pop() # Drop trailing user/system message
-
-    # 4. Final check for strict user/assistant alternation
-    final_chat = []
-    if merged and merged[0]["role"] == "system":
-        final_chat.append(merged.pop(0))
-        
-    if not merged or len(merged) % 2 != 0: # Must be an even number of user/assistant turns
+        role = msg["role"]
+        # Merge true consecutive messages of the same role
+        if out and out[-1]["role"] == role:
+            out[-1]["content"] = (out[-1]["content"] + "\n\n" + msg["content"]).strip()
+            continue
+        if role == "system" and out:
+            n_misplaced_system += 1
+        out.append(msg)
+
+    # Ensure the conversation ends with an assistant message
+    if out[-1]["role"] != "assistant":
+        dropped = out.pop() # Drop trailing user/system message
+        if dropped["role"] == "system" and out:
+            n_misplaced_system -= 1
+
+    if n_misplaced_system or not out:
         return None
-        
-    for i, msg in enumerate(merged):
-        expected_role = "user" if i % 2 == 0 else "assistant"
-        if msg["role"] != expected_role:
-            return None # The sequence is broken
-        final_chat.append(msg)
 
-    return final_chat if len(final_chat) >= 2 else None
+    # Final check: after an optional system message, the body must run user ... assistant
+    start = 1 if out[0]["role"] == "system" else 0
+    if len(out) - start < 2 or out[start]["role"] != "user" or out[-1]["role"] != "assistant":
+        return None # The sequence is broken
+    return out
 
 
 def _normalize_row(row: Dict[str, Any], keep_keys: List[str]) -> Optional[Dict[str, Any]]:
@@ -89,6 +128,13 @@ def _normalize_row(row: Dict[str, Any], keep_keys: List[str]) -> Optional[Dict[s
     msgs = row.get("messages")
     if not isinstance(msgs, list): return None
 
+    # Cheap pre-check on the raw text: normalization can't move a leading "rt", so a final assistant
+    # message that already starts with it is a retweet the check below would drop anyway.
+    last = next((m for m in reversed(msgs) if m.get("content")), None)
+    if last is not None and _map_role(last.get("role")) == "assistant":
+        if last["content"].lstrip()[:2].lower() == "rt":
+            return None
+
     cleaned_msgs = [{"role": _map_role(m.get("role")), "content": _norm_text(m.get("content"))} for m in msgs if m.get("content")]
     
     # Filter out retweets by checking the assistant's final message
@@ -100,9 +146,10 @@ def _normalize_row(row: Dict[str, Any], keep_keys: List[str]) -> Optional[Dict[s
     if not fixed_msgs: return None
 
     norm_row = {"messages": fixed_msgs}
+    # Rows come from JSON, which has no datetime type, so values are copied as-is
     for key in keep_keys:
         if key != "messages" and key in row:
-            norm_row[key] = str(row[key]) if isinstance(row[key], datetime) else row[key]
+            norm_row[key] = row[key]
             
     return norm_row
 
@@ -113,42 +160,59 @@ def _is_generic_prompt(prompt: str) -> bool:
     p_lower = prompt.lower()
     return p_lower == "..." or p_lower.startswith("write a")
 
-def _analyze_dataset_quality(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Analyzes the unified dataset and returns a dictionary of metrics."""
-    if not rows: return {}
-
-    source_counts = Counter(row.get("source_file", "unknown") for row in rows)
-    
-    turn_counts = Counter()
-    generic_prompts = 0
-    total_prompt_len = 0
-    total_response_len = 0
-
-    for row in rows:
-        messages = row.get("messages", [])
-        user_turns = [m for m in messages if m["role"] == "user"]
-        
-        turn_counts[len(user_turns)] += 1
-            
-        if user_turns and _is_generic_prompt(user_turns[-1]["content"]):
-            generic_prompts += 1
-            
-        total_prompt_len += sum(len(m["content"]) for m in user_turns)
-        total_response_len += sum(len(m["content"]) for m in messages if m["role"] == "assistant")
-
-    total = len(rows)
-    single_turn_count = turn_counts.get(1, 0)
-    multi_turn_count = total - single_turn_count
-    
-    return {
-        "total_examples": total,
-        "source_composition": {k: v / total for k, v in source_counts.items()},
-        "single_turn_pct": single_turn_count / total,
-        "multi_turn_pct": multi_turn_count / total,
-        "generic_prompt_pct": generic_prompts / total,
-        "avg_prompt_len": total_prompt_len / total if total > 0 else 0,
-        "avg_response_len": total_response_len / total if total > 0 else 0,
-    }
+def _has_generic_prompt(messages: List[Dict[str, str]]) -> bool:
+    """True if the conversation's last user turn is a generic placeholder."""
+    last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), None)
+    return last_user is not None and _is_generic_prompt(last_user)
+
+class _QualityStats:
+    """Accumulates dataset quality metrics one row at a time, so rows can stream straight to disk."""
+
+    def __init__(self):
+        self.source_counts: Counter = Counter()
+        self.total = 0
+        # Only single- vs. multi-turn is reported, so a counter replaces a full histogram
+        self.single_turn = 0
+        self.generic_prompts = 0
+        self.prompt_len = 0
+        self.response_len = 0
+
+    def add(self, row: Dict[str, Any]):
+        # One pass over the row's messages, accumulating into locals
+        n_user = prompt_len = response_len = 0
+        last_user = None
+        for m in row.get("messages", []):
+            role = m["role"]
+            if role == "user":
+                n_user += 1
+                last_user = m["content"]
+                prompt_len += len(last_user)
+            elif role == "assistant":
+                response_len += len(m["content"])
+
+        self.source_counts[row.get("source_file", "unknown")] += 1
+        self.total += 1
+        self.prompt_len += prompt_len
+        self.response_len += response_len
+        if n_user == 1:
+            self.single_turn += 1
+        if last_user is not None and _is_generic_prompt(last_user):
+            self.generic_prompts += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns the metrics dictionary used by the quality report."""
+        total = self.total
+        if not total: return {}
+
+        return {
+            "total_examples": total,
+            "source_composition": {k: v / total for k, v in self.source_counts.items()},
+            "single_turn_pct": self.single_turn / total,
+            "multi_turn_pct": (total - self.single_turn) / total,
+            "generic_prompt_pct": self.generic_prompts / total,
+            "avg_prompt_len": self.prompt_len / total,
+            "avg_response_len": self.response_len / total,
+        }
 
 def _print_quality_report(metrics: Dict[str, Any]):
     """Prints the formatted data quality report."""
@@ -180,27 +244,81 @@ def _print_quality_report(metrics: Dict[str, Any]):
 
 # --- File I/O ---
 
+WRITE_BUFFER_BYTES = 4 << 20  # Output buffered before each write()
+
+def _iter_lines(f) -> Iterable[bytes]:
+    """
+    Yields the lines of a binary file (without newlines) from a read-only memory map,
+    so the OS pages the file in and no read buffers are copied through Python.
+    """
+    if os.fstat(f.fileno()).st_size == 0: # mmap can't map an empty file
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        find = mm.find
+        i = 0
+        while (j := find(b"\n", i)) != -1:
+            yield mm[i:j]
+            i = j + 1
+        if i < len(mm):
+            yield mm[i:]
+
 def _iter_jsonl(paths: List[pathlib.Path]) -> Iterable[Dict[str, Any]]:
+    # Lines are parsed straight from bytes, skipping the text decode layer
     for p in paths:
-        with p.open("r", encoding="utf-8") as f:
-            for line in f:
+        with p.open("rb") as f:
+            for line in _iter_lines(f):
                 if line.strip():
                     try:
-                        row = json.loads(line)
+                        row = fast_json.loads(line)
                         row["source_file"] = p.name
                         yield row
-                    except json.JSONDecodeError:
+                    except json.JSONDecodeError: # Also raised by orjson, including for invalid UTF-8
                         continue
 
-def _save_jsonl(p: pathlib.Path, rows: List[Dict[str, Any]]):
+def _save_jsonl(p: pathlib.Path, rows: Iterable[Dict[str, Any]]):
+    # Encoded lines accumulate in one reusable buffer that is flushed every few MiB
     p.parent.mkdir(parents=True, exist_ok=True)
-    with p.open("w", encoding="utf-8") as f:
+    buf = bytearray()
+    with p.open("wb") as f:
         for ex in rows:
             ex.pop("source_file", None)
-            f.write(json.dumps(ex, ensure_ascii=False) + "\n")
+            buf += fast_json.dumps(ex)
+            buf += b"\n"
+            if len(buf) >= WRITE_BUFFER_BYTES:
+                f.write(buf)
+                buf.clear()
+        f.write(buf)
 
 # --- Main Unify Function ---
 
+PARALLEL_MIN_BYTES = 16 << 20  # Smaller inputs are normalized inline; pool startup would dominate
+MAP_BATCH = 32768  # Rows handed to the pool at a time, bounding memory while streaming
+MAP_CHUNKSIZE = 1024
+
+def _process_row(
+    row: Dict[str, Any], keep_keys: List[str], drop_generic_prompts: bool
+) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Normalizes a raw row and computes its dedup hash. Top-level so worker processes can run it."""
+    norm_row = _normalize_row(row, keep_keys)
+    if not norm_row: return None
+    
+    # Optionally drop rows with generic prompts
+    if drop_generic_prompts and _has_generic_prompt(norm_row["messages"]):
+        return None
+
+    return _hash_for_dedup(norm_row["messages"]), norm_row
+
+def _map_rows(fn, rows: Iterable[Dict[str, Any]], workers: int) -> Iterable[Any]:
+    """Applies fn to rows in input order, in worker processes unless workers == 1."""
+    if workers == 1:
+        yield from map(fn, rows)
+        return
+    rows = iter(rows)
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        # Executor.map submits its whole input up front, so feed it bounded batches
+        while batch := list(islice(rows, MAP_BATCH)):
+            yield from executor.map(fn, batch, chunksize=MAP_CHUNKSIZE)
+
 def unify_datasets(
     input_paths: List[pathlib.Path],
     output_path: pathlib.Path,
@@ -208,39 +326,66 @@ def unify_datasets(
     seed: int,
     keep_keys: List[str],
     drop_generic_prompts: bool,
+    workers: int = 0,
 ):
     """Unifies multiple JSONL datasets into a single, normalized file."""
-    all_rows = list(tqdm(_iter_jsonl(input_paths), desc="Reading files"))
-    
-    kept, seen_hashes = [], set()
-    for row in tqdm(all_rows, desc="Normalizing and deduplicating"):
-        norm_row = _normalize_row(row, keep_keys + ["source_file"])
-        if not norm_row: continue
-        
-        # Optionally drop rows with generic prompts
-        if drop_generic_prompts:
-            user_turns = [m for m in norm_row["messages"] if m["role"] == "user"]
-            if user_turns and _is_generic_prompt(user_turns[-1]["content"]):
-                continue
-
-        h = _hash_for_dedup(norm_row["messages"])
-        if h in seen_hashes: continue
-        
-        seen_hashes.add(h)
-        kept.append(norm_row)
-
+    if sum(p.stat().st_size for p in input_paths) < PARALLEL_MIN_BYTES:
+        workers = 1
+
+    n_read = 0
+    def _read_rows():
+        nonlocal n_read
+        for row in _iter_jsonl(input_paths):
+            n_read += 1
+            yield row
+
+    # Rows are normalized as they are read, so raw rows are never all held in memory.
+    # Normalization runs in parallel; dedup stays here, in input order, so the first occurrence wins.
+    process = functools.partial(
+        _process_row, keep_keys=keep_keys + ["source_file"], drop_generic_prompts=drop_generic_prompts
+    )
+    seen_hashes: Set[int] = set()
+    def _unique_rows():
+        for result in tqdm(_map_rows(process, _read_rows(), workers), desc="Unifying"):
+            if not result: continue
+
+            h, norm_row = result
+            if h in seen_hashes: continue
+            
+            seen_hashes.add(h)
+            yield norm_row
+
+    stats = _QualityStats()
+    def _observed(rows):
+        for row in rows: # Stats are taken before _save_jsonl drops source_file
+            stats.add(row)
+            yield row
+
+    # Exact dedup only needs the 128-bit digests in memory. Unique rows are buffered only when
+    # they must be shuffled; otherwise each one is written out as soon as it is accepted.
+    rows = _unique_rows()
     if shuffle:
-        random.Random(seed).shuffle(kept)
+        rows = list(rows)
+        random.Random(seed).shuffle(rows)
 
-    quality_metrics = _analyze_dataset_quality(kept)
-    _save_jsonl(output_path, kept)
-    print(f"✅ Unified {len(kept)} rows from {len(all_rows)} inputs into {output_path}")
+    _save_jsonl(output_path, _observed(rows))
+    print(f"✅ Unified {stats.total} rows from {n_read} inputs into {output_path}")
 
-    _print_quality_report(quality_metrics)
+    _print_quality_report(stats.metrics())
 
 
 # --- Main Split Function ---
 
+def _count_nonblank_lines(path: pathlib.Path) -> int:
+    with path.open("rb") as f:
+        return sum(1 for line in _iter_lines(f) if line.strip())
+
+def _eval_size(n_rows: int, eval_pct: float) -> int:
+    """Eval rows for a split: at least one, but always leaving one for train."""
+    if n_rows <= 1:
+        return 0
+    return min(max(1, int(round(n_rows * eval_pct))), n_rows - 1)
+
 def split_dataset(
     input_path: pathlib.Path,
     train_path: pathlib.Path,
@@ -249,19 +394,36 @@ def split_dataset(
     seed: int,
 ):
     """Splits a JSONL dataset into training and evaluation sets."""
-    rows = list(_iter_jsonl([input_path]))
-    if not rows:
+    # A raw line count fixes the eval size without parsing anything; the split itself then
+    # decodes each row once and streams, with only the eval reservoir in memory.
+    n_lines = _count_nonblank_lines(input_path)
+    if not n_lines:
         print(f"No rows found in {input_path} to split.")
         return
-
-    random.Random(seed).shuffle(rows)
-    
-    n_eval = max(1, int(round(len(rows) * eval_pct)))
-    n_eval = min(n_eval, len(rows) - 1) if len(rows) > 1 else 0
-
-    train_set = rows[:-n_eval] if n_eval > 0 else rows
-    eval_set = rows[-n_eval:] if n_eval > 0 else []
-
-    _save_jsonl(train_path, train_set)
-    _save_jsonl(eval_path, eval_set)
-    print(f"✅ Split {len(rows)} rows into {len(train_set)} train and {len(eval_set)} eval files.")
+    n_eval = _eval_size(n_lines, eval_pct)
+
+    # Reservoir sampling (Algorithm R): every row ends up in eval with probability n_eval / n_rows.
+    # Rows that are never picked, or are evicted from the reservoir, go to train as they stream past.
+    rng = random.Random(seed)
+    reservoir: List[Dict[str, Any]] = []
+    n_rows = 0
+    def _train_rows():
+        nonlocal n_rows
+        for i, row in enumerate(_iter_jsonl([input_path])):
+            n_rows = i + 1
+            if i < n_eval:
+                reservoir.append(row)
+                continue
+            j = rng.randint(0, i)
+            if j < n_eval:
+                row, reservoir[j] = reservoir[j], row
+            yield row
+
+    _save_jsonl(train_path, _train_rows())
+    if n_rows <= n_eval:
+        # Only possible when unparseable lines inflated the count and no row reached train
+        keep = _eval_size(n_rows, eval_pct)
+        _save_jsonl(train_path, reservoir[keep:])
+        del reservoir[keep:]
+    _save_jsonl(eval_path, reservoir)
+    print(f"✅ Split {n_rows} rows into {n_rows - len(reservoir)} train and {len(reservoir)} eval files.")
@@ -13,6 +13,11 @@ URL_RE = re.compile(r"https?://\S+")
 WS_RE = re.compile(r"\s+")
 TAG_RE = re.compile(r"<[^>]+>")
 A_TEXT_RE = re.compile(r">([^<]+)<")
+HASH_AT_RE = re.compile(r"[#@]\w+")
+EDIT_RE = re.compile(r"this tweet was edited at\s.*$", re.IGNORECASE)
+
+# Strips RTL/LTR marks in one C-level pass. Line endings need no separate handling: WS_RE folds \r and \n alike.
+BIDI_MARKS = str.maketrans("", "", "\u200f\u200e")
 
 TW_TIME_FMTS = (
     "%a %b %d %H:%M:%S %z %Y",
@@ -27,10 +32,9 @@ def clean_text(t: str) -> str:
     if not t: return ""
     t = html.unescape(t)
     t = URL_RE.sub("", t)
-    t = re.sub(r"[#@]\w+", "", t)
-    t = re.sub(r'this tweet was edited at\s.*$', '', t, flags=re.IGNORECASE)
-    t = t.replace("\u200f", "").replace("\u200e", "")
-    t = t.replace("\r\n", "\n").replace("\r", "\n")
+    t = HASH_AT_RE.sub("", t)
+    t = EDIT_RE.sub("", t)
+    t = t.translate(BIDI_MARKS)
     t = WS_RE.sub(" ", t).strip()
     return t
 
@@ -42,22 +46,43 @@ def parse_source_app(src_html: Optional[str]) -> str:
     m = A_TEXT_RE.search(src_html)
     return clean_text(m.group(1)) if m else clean_text(TAG_RE.sub("", src_html))
 
+# The TW_TIME_FMTS shapes are mutually exclusive, so trying the last one that worked first
+# (an archive uses a single format throughout) cannot change the result, only skip failed attempts.
+_last_ts_fmt = TW_TIME_FMTS[0]
+
+def _from_isoformat(s: str) -> Optional[datetime]:
+    try:
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+def _strptime_utc(s: str, fmt: str) -> Optional[datetime]:
+    try:
+        dt = datetime.strptime(s, fmt)
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
 def parse_ts(s: Optional[str]) -> Optional[datetime]:
+    global _last_ts_fmt
     if not s: return None
     s = s.strip().replace("Z", "+00:00")
+    # API timestamps ("2023-01-01T12:00:00.000Z") carry fractional seconds that no strptime format
+    # matches; send ISO-shaped strings straight to fromisoformat instead of failing through every format.
+    if len(s) > 10 and s[4] == "-" and s[10] == "T":
+        dt = _from_isoformat(s)
+        if dt: return dt
+    dt = _strptime_utc(s, _last_ts_fmt)
+    if dt: return dt
     for fmt in TW_TIME_FMTS:
-        try:
-            dt = datetime.strptime(s, fmt)
-            if not dt.tzinfo: dt = dt.replace(tzinfo=timezone.utc)
+        if fmt is _last_ts_fmt:
+            continue  # Already tried above
+        dt = _strptime_utc(s, fmt)
+        if dt:
+            _last_ts_fmt = fmt
             return dt
-        except Exception:
-            pass
-    try:
-        dt = datetime.fromisoformat(s)
-        if not dt.tzinfo: dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except Exception:
-        return None
+    return _from_isoformat(s)
 
 # --- Data Loading ---
 
@@ -2,38 +2,230 @@
 
 import os
 import math
-from pathlib import Path  # <-- FIX: Import the Path object
-from typing import Dict, Any
+import re
+import bisect
+import functools
+import hashlib
+from typing import Callable, Dict, Any, List, Optional, Union
 
 import torch
-from datasets import load_dataset
+from datasets import Dataset, IterableDataset, load_dataset
 from transformers import (
     AutoTokenizer,
     AutoConfig,
     AutoModelForCausalLM,
     BitsAndBytesConfig,
+    DataCollatorForLanguageModeling,
 )
 from peft import LoraConfig
 from trl import SFTTrainer, SFTConfig
 
 # --- Data Helpers ---
 
-def _jsonl_to_dataset(path: str):
-    return load_dataset("json", data_files=path, split="train")
+MAP_BATCH_SIZE = 1000
 
-def _apply_chat_template(example: Dict[str, Any], tokenizer: AutoTokenizer) -> Dict[str, str]:
-    """Applies the chat template to a single example."""
-    msgs = example.get("messages")
-    text = ""
-    if isinstance(msgs, list):
+def _jsonl_to_dataset(path: str, cache_dir: Optional[str] = None, streaming: bool = False):
+    return load_dataset("json", data_files=path, split="train", cache_dir=cache_dir, streaming=streaming)
+
+def _render_messages(msgs: Any, tokenizer: AutoTokenizer) -> str:
+    """Applies the chat template to a single message list."""
+    if not isinstance(msgs, list):
+        return ""
+    try:
+        return tokenizer.apply_chat_template(
+            msgs, tokenize=False, add_generation_prompt=False
+        )
+    except Exception:
+        # Fallback for templates that might fail
+        return _join_messages(msgs)
+
+def _join_messages(msgs: List[Dict[str, Any]]) -> str:
+    """Plain `role: content` rendering; Arrow fills missing struct keys with None, hence `or`."""
+    return "\n".join([f"{m.get('role') or 'user'}: {m.get('content') or ''}" for m in msgs])
+
+def _apply_chat_template(examples: Dict[str, List[Any]], tokenizer: AutoTokenizer) -> Dict[str, List[str]]:
+    """Applies the chat template to a batch of examples, rendering all conversations in one call."""
+    batch = examples["messages"]
+    convs = [msgs for msgs in batch if isinstance(msgs, list)]
+    try:
+        # The template is resolved and compiled once per batch rather than once per row
+        rendered = iter(tokenizer.apply_chat_template(convs, tokenize=False, add_generation_prompt=False) if convs else ())
+    except Exception:
+        if getattr(tokenizer, "chat_template", None) is None:
+            # No template at all: every row would fail, so join the whole batch directly
+            return {"text": [_join_messages(msgs) if isinstance(msgs, list) else "" for msgs in batch]}
+        # A single bad row fails the whole call; retry row by row so only it falls back
+        return {"text": [_render_messages(msgs, tokenizer) for msgs in batch]}
+    return {"text": [next(rendered) if isinstance(msgs, list) else "" for msgs in batch]}
+
+def _tokenize(examples: Dict[str, List[str]], tokenizer: AutoTokenizer, max_length: int) -> Dict[str, List[List[int]]]:
+    """Tokenizes a batch of rendered texts and records each sequence's length. Empty renders are dropped."""
+    texts = [text for text in examples["text"] if text]
+    enc = tokenizer(texts, truncation=True, max_length=max_length, return_attention_mask=True)
+    return {**enc, "length": [len(ids) for ids in enc["input_ids"]]}
+
+def _best_fit_decreasing(sizes: List[int], capacity: int) -> List[List[int]]:
+    """Groups item indices into bins of at most `capacity`, placing each item (largest first) in the fullest bin it fits."""
+    order = sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True)
+    bins: List[List[int]] = []
+    by_space: Dict[int, List[int]] = {}  # remaining capacity -> open bins
+    spaces: List[int] = []               # sorted keys of by_space; at most `capacity` entries
+    for i in order:
+        size = sizes[i]
+        j = bisect.bisect_left(spaces, size)
+        if j < len(spaces):
+            space = spaces[j]
+            open_bins = by_space[space]
+            b = open_bins.pop()
+            if not open_bins:
+                del by_space[space]
+                del spaces[j]
+        else:
+            b, space = len(bins), capacity
+            bins.append([])
+        bins[b].append(i)
+        rest = space - size
+        if rest > 0:
+            if rest in by_space:
+                by_space[rest].append(b)
+            else:
+                by_space[rest] = [b]
+                bisect.insort(spaces, rest)
+    return bins
+
+def _fill_bins(batch: Dict[str, List[List[int]]], source, eos_token_id: int, capacity: int) -> Dict[str, List[List[int]]]:
+    """Materializes a batch of bins: member sequences joined with EOS. The collator pads each batch."""
+    seqs = iter(source.select([i for members in batch["members"] for i in members])["input_ids"])
+    input_ids = []
+    for members in batch["members"]:
+        row: List[int] = []
+        for _ in members:
+            row.extend(next(seqs)[:capacity - 1])
+            row.append(eos_token_id)
+        input_ids.append(row)
+    return {"input_ids": input_ids, "attention_mask": [[1] * len(row) for row in input_ids]}
+
+def _pack_dataset(ds, tokenizer: AutoTokenizer, capacity: int, num_proc: Optional[int], desc: str):
+    """Packs tokenized rows into sequences of at most `capacity` with best-fit decreasing instead of greedy concatenation."""
+    sizes = [min(n + 1, capacity) for n in ds["length"]]  # +1 for the EOS separator
+    bins = _best_fit_decreasing(sizes, capacity)
+    print(f"Packing: {len(sizes)} sequences into {len(bins)} bins of {capacity} tokens "
+          f"({sum(sizes) / max(1, len(bins) * capacity):.1%} full)")
+    fill = functools.partial(_fill_bins, source=ds, eos_token_id=tokenizer.eos_token_id, capacity=capacity)
+
+    # The bins are a pure function of the tokenized rows, so the packed stage is keyed on the
+    # source fingerprint and cached beside its Arrow files; hashing `fill` would hash the source.
+    fingerprint = hashlib.sha256(
+        f"pack-bfd-v1|{ds._fingerprint}|{capacity}|{tokenizer.eos_token_id}".encode()
+    ).hexdigest()[:16]
+    cache_file_name = None
+    if ds.cache_files:
+        cache_dir = os.path.dirname(ds.cache_files[0]["filename"])
+        cache_file_name = os.path.join(cache_dir, f"cache-packed-{fingerprint}.arrow")
+    return _map_batched(
+        Dataset.from_dict({"members": bins}), fill, num_proc, desc=desc,
+        new_fingerprint=fingerprint, cache_file_name=cache_file_name,
+    )
+
+def _map_batched(ds, fn, num_proc: Optional[int], desc: str, remove_columns: Optional[List[str]] = None, **cache_kwargs):
+    """Batched, multi-process map; results are cached next to the Arrow files and reused on re-runs."""
+    if isinstance(ds, IterableDataset):
+        # Lazy, single-process: rows are transformed as the trainer pulls them.
+        # Streamed JSON doesn't know its columns up front, so callers name them.
+        return ds.map(fn, batched=True, batch_size=MAP_BATCH_SIZE, remove_columns=remove_columns)
+    return ds.map(
+        fn,
+        batched=True,
+        batch_size=MAP_BATCH_SIZE,
+        num_proc=num_proc,
+        load_from_cache_file=True,
+        remove_columns=ds.column_names,
+        desc=desc,
+        **cache_kwargs,
+    )
+
+def _is_streaming(config: Dict[str, Any]) -> bool:
+    return bool(config.get("streaming"))
+
+def _is_packing(config: Dict[str, Any]) -> bool:
+    # Best-fit packing needs every length up front, which a stream can't provide
+    return not config.get("no_packing", False) and not _is_streaming(config)
+
+def _prepare_dataset(ds, split: str, config: Dict[str, Any], tokenizer: AutoTokenizer,
+                     template_fn: Callable, tokenize_fn: Callable):
+    """Turns a loaded JSONL split into model-ready `input_ids` in one cached pass per stage."""
+    num_proc = config.get("map_num_proc", os.cpu_count())
+    cutoff_len = config.get("cutoff_len", 1024)
+    packing = _is_packing(config)
+
+    ds = ds.select_columns(["messages"])
+    ds = _map_batched(
+        ds, template_fn, num_proc,
+        desc=f"Applying chat template to {split} set", remove_columns=["messages"],
+    )
+    ds = _map_batched(
+        ds, tokenize_fn, num_proc,
+        desc=f"Tokenizing {split} set", remove_columns=["text"],
+    )
+    if packing:
+        return _pack_dataset(ds, tokenizer, cutoff_len, num_proc, desc=f"Packing {split} set")
+    # Unpacked rows keep `length` so length-grouped batching doesn't re-measure them
+    return ds
+
+# --- Model Helpers ---
+
+def _attn_candidates(config: Dict[str, Any], device: str, half_precision: bool) -> List[str]:
+    """Attention backends to try, fastest first. An explicit `attn_impl` is used as-is."""
+    if config.get("attn_impl"):
+        return [config["attn_impl"]]
+    if device == "cuda" and half_precision:
+        # FlashAttention-2 only runs in fp16/bf16
+        return ["flash_attention_2", "sdpa", "eager"]
+    return ["sdpa", "eager"]
+
+def _load_model(model_name: str, attn_impls: List[str], **kwargs):
+    """Loads the model with the first attention implementation the environment and architecture support."""
+    for i, attn_impl in enumerate(attn_impls):
         try:
-            text = tokenizer.apply_chat_template(
-                msgs, tokenize=False, add_generation_prompt=False
-            )
-        except Exception:
-            # Fallback for templates that might fail
-            text = "\n".join(f"{m.get('role', 'user')}: {m.get('content', '')}" for m in msgs)
-    return {"text": text}
+            model = AutoModelForCausalLM.from_pretrained(model_name, attn_implementation=attn_impl, **kwargs)
+        except (ImportError, ValueError) as e:
+            if i == len(attn_impls) - 1:
+                raise
+            print(f"Attention '{attn_impl}' unavailable ({e}). Trying '{attn_impls[i + 1]}'.")
+            continue
+        print(f"Attention implementation: {attn_impl}")
+        return model
+
+def _device_map(config: Dict[str, Any], device: str):
+    """Keeps the whole model on one GPU per process; sharding via "auto" only for a single process over several GPUs."""
+    if device != "cuda":
+        return None
+    if config.get("device_map"):
+        return config["device_map"]
+    if "LOCAL_RANK" in os.environ:
+        # Launched by torchrun / accelerate: one full replica per rank
+        return {"": int(os.environ["LOCAL_RANK"])}
+    return {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
+_MODULE_NAME_RE = re.compile(r"[\w.]+")
+
+def _parse_target_modules(spec: Any) -> Union[str, List[str]]:
+    """
+    Comma-separated module names become a list. "all-linear" and regular expressions
+    (matched by PEFT against full module paths) are passed through as a string.
+    """
+    if isinstance(spec, (list, tuple)):
+        return [str(t).strip() for t in spec if str(t).strip()]
+    spec = (spec or "").strip()
+    if spec == "all-linear" or ("," not in spec and spec and not _MODULE_NAME_RE.fullmatch(spec)):
+        return spec
+    return [t.strip() for t in spec.split(",") if t.strip()]
+
+def _default_optim(config: Dict[str, Any], device: str) -> str:
+    """Paged 8-bit AdamW for QLoRA (bitsandbytes is already required there), fused AdamW on CUDA otherwise."""
+    if config.get("load_in_4bit"):
+        return "paged_adamw_8bit"
+    return "adamw_torch_fused" if device == "cuda" else "adamw_torch"
 
 # --- Main Training Function ---
 
@@ -56,6 +248,10 @@ def run_training(config: Dict[str, Any]):
         if use_bf16 and not torch.cuda.is_bf16_supported():
             print("Warning: BF16 requested but not supported. Falling back to FP16.")
             use_bf16, use_fp16 = False, True
+        # TF32 tensor cores for fp32 matmuls (Ampere+); bf16/fp16 math is unaffected
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
     else:
         use_bf16, use_fp16 = False, False # No half-precision on CPU
 
@@ -64,25 +260,45 @@ def run_training(config: Dict[str, Any]):
     # --- Tokenizer ---
     token = os.getenv("HUGGINGFACE_HUB_TOKEN")
     tokenizer = AutoTokenizer.from_pretrained(config["model_name"], use_fast=True, token=token)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
     tokenizer.padding_side = "right"
 
     # --- Datasets ---
-    train_ds = _jsonl_to_dataset(config["data"]).map(
-        lambda ex: _apply_chat_template(ex, tokenizer),
-        desc="Applying chat template to train set"
+    if _is_streaming(config):
+        if config.get("max_steps", -1) <= 0:
+            raise ValueError("Streaming datasets have no length; set 'max_steps' to train with 'streaming'.")
+        print("Streaming training data: packing and length grouping are disabled.")
+    # Tokenized (and packed) once up front, so the trainer only collates ids.
+    # The tokenizer-bound map functions are built once and shared by both splits.
+    build_ds = functools.partial(
+        _prepare_dataset,
+        config=config,
+        tokenizer=tokenizer,
+        template_fn=functools.partial(_apply_chat_template, tokenizer=tokenizer),
+        tokenize_fn=functools.partial(_tokenize, tokenizer=tokenizer, max_length=config.get("cutoff_len", 1024)),
     )
+    cache_dir = config.get("cache_dir")
+    train_ds = build_ds(_jsonl_to_dataset(config["data"], cache_dir, streaming=_is_streaming(config)), "train")
     eval_ds = None
-    if config.get("eval") and Path(config["eval"]).exists():
-        eval_ds = _jsonl_to_dataset(config["eval"]).map(
-            lambda ex: _apply_chat_template(ex, tokenizer),
-            desc="Applying chat template to eval set"
-        )
+    if config.get("eval"):
+        # Only a missing eval file means "no eval set"; errors from the map stages still surface
+        try:
+            raw_eval = _jsonl_to_dataset(config["eval"], cache_dir)
+        except FileNotFoundError:
+            print(f"Eval set not found at '{config['eval']}'. Skipping evaluation.")
+        else:
+            eval_ds = build_ds(raw_eval, "eval")
 
     # --- Quantization (QLoRA) ---
+    model_name = config["model_name"]
     quantization_config = None
-    if config.get("load_in_4bit"):
+    if config.get("load_in_4bit") and config.get("model_name_4bit"):
+        # Pre-quantized checkpoint: its quantization config ships with the weights,
+        # so there is no full-precision download and no load-time NF4 pass.
+        model_name = config["model_name_4bit"]
+        print(f"QLoRA: Loading pre-quantized checkpoint: {model_name}")
+    elif config.get("load_in_4bit"):
         compute_dtype = torch.bfloat16 if use_bf16 else torch.float16
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
@@ -94,54 +310,103 @@ def run_training(config: Dict[str, Any]):
 
     # --- Model Loading ---
     torch_dtype = torch.bfloat16 if use_bf16 else (torch.float16 if use_fp16 else torch.float32)
-    model = AutoModelForCausalLM.from_pretrained(
-        config["model_name"],
+    model = _load_model(
+        model_name,
+        _attn_candidates(config, device, use_bf16 or use_fp16),
         token=token,
         torch_dtype=torch_dtype,
-        attn_implementation=config.get("attn_impl", "eager"),
-        device_map="auto" if device == "cuda" else None,
+        device_map=_device_map(config, device),
         quantization_config=quantization_config,
+        # Load weights straight into their final dtype/device in one pass (safetensors are mmapped)
+        low_cpu_mem_usage=True,
         trust_remote_code=True,
     )
 
+    model.config.pad_token_id = tokenizer.pad_token_id
+
     if config.get("gradient_checkpointing"):
         model.config.use_cache = False
+        # With frozen base weights, non-reentrant checkpointing needs the inputs to carry grads
+        model.enable_input_require_grads()
+
+    # --- torch.compile (opt-in) ---
+    use_compile = bool(config.get("compile")) and device == "cuda"
+    if use_compile:
+        # LoRA/NF4 graphs trip the default recompile limit
+        torch._dynamo.config.cache_size_limit = 10000
+        if _is_packing(config):
+            # Packed batches are padded to exactly cutoff_len below, so static shapes never recompile.
+            # Unpacked batches are padded per batch; they keep dynamic shapes to avoid a recompile per length.
+            torch._dynamo.config.automatic_dynamic_shapes = False
 
     # --- LoRA Config ---
-    target_modules = [t.strip() for t in config.get("target_modules", "").split(",") if t.strip()]
+    target_modules = _parse_target_modules(config.get("target_modules", ""))
+    if not target_modules:
+        # Under QLoRA the frozen base is 4-bit, so adapting the MLP projections too costs little VRAM
+        target_modules = "all-linear" if config.get("load_in_4bit") else ["q_proj", "k_proj", "v_proj", "o_proj"]
     peft_config = LoraConfig(
         r=config.get("lora_r", 16),
         lora_alpha=config.get("lora_alpha", 32),
         lora_dropout=config.get("lora_dropout", 0.05),
         bias="none",
         task_type="CAUSAL_LM",
-        target_modules=target_modules or ["q_proj", "k_proj", "v_proj", "o_proj"],
+        target_modules=target_modules,
     )
 
     # --- SFT Trainer Config ---
+    num_workers = config.get("dataloader_workers", min(8, os.cpu_count() or 1))
     sft_config = SFTConfig(
         output_dir=config["output_dir"],
         per_device_train_batch_size=config.get("batch_size", 2),
         gradient_accumulation_steps=config.get("grad_accum", 8),
         learning_rate=config.get("lr", 2e-4),
+        optim=config.get("optim", _default_optim(config, device)),
         num_train_epochs=config.get("epochs", 1),
+        max_steps=config.get("max_steps", -1),
         logging_steps=config.get("logging_steps", 20),
         save_steps=config.get("save_steps", 200),
         seed=config.get("seed", 42),
         bf16=use_bf16,
         fp16=use_fp16,
         gradient_checkpointing=config.get("gradient_checkpointing", False),
-        dataset_text_field="text",
+        # Non-reentrant checkpointing composes with torch.compile, fused attention backward and DDP
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        # Under DDP, skip the unused-parameter scan and all-reduce only on the
+        # last micro-step of each accumulation window (no_sync on the rest).
+        ddp_find_unused_parameters=False,
+        # Collate in background workers so batches are ready (and pinned) before the GPU needs them
+        dataloader_num_workers=num_workers,
+        dataloader_pin_memory=device == "cuda",
+        dataloader_persistent_workers=num_workers > 0,
+        dataloader_prefetch_factor=4 if num_workers > 0 else None,
+        # The Trainer compiles after PEFT has wrapped the model, so LoRA layers are traced too
+        torch_compile=use_compile,
+        torch_compile_mode=config.get("compile_mode", "max-autotune-no-cudagraphs") if use_compile else None,
+        accelerator_config={"gradient_accumulation_kwargs": {"sync_each_batch": False}},
         max_seq_length=config.get("cutoff_len", 1024),
-        packing=not config.get("no_packing", False),
+        # Datasets arrive pre-tokenized and, unless `no_packing`, pre-packed.
+        packing=False,
+        dataset_kwargs={"skip_prepare_dataset": True},
+        # Without packing, batch similar lengths together to cut padding
+        group_by_length=not _is_packing(config) and not _is_streaming(config),
+        length_column_name="length",
     )
 
+    # Packed rows are stored at their real length and padded per batch, except under
+    # torch.compile, where every packed batch is padded to cutoff_len for one static shape.
+    data_collator = None
+    if use_compile and _is_packing(config):
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer, mlm=False, pad_to_multiple_of=config.get("cutoff_len", 1024)
+        )
+
     trainer = SFTTrainer(
         model=model,
         args=sft_config,
         peft_config=peft_config,
         train_dataset=train_ds,
         eval_dataset=eval_ds,
+        data_collator=data_collator,
         tokenizer=tokenizer,
     )
 
@@ -0,0 +1,34 @@
+# tests/test_cli.py
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("typer")
+pytest.importorskip("dotenv")
+
+from lora_sftuner import cli
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("3", 3),
+    ("-1", -1),
+    ("1e-4", 1e-4),
+    ("-0.5", -0.5),
+    ("true", True),
+    ("False", False),
+    ("q_proj,v_proj", "q_proj,v_proj"),
+])
+def test_coerce_cli_value(raw, expected):
+    value = cli._coerce_cli_value(raw)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+def test_negative_int_override_stays_int(monkeypatch):
+    monkeypatch.setattr(cli, "config", {})
+    ctx = SimpleNamespace(args=["--max-steps", "-1", "--seed", "-1", "--lr", "1e-4"])
+    settings = cli._build_train_config(ctx, preset=None)
+    assert settings["max_steps"] == -1 and isinstance(settings["max_steps"], int)
+    assert settings["seed"] == -1 and isinstance(settings["seed"], int)
+    assert settings["lr"] == 1e-4